@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+import numpy as np
+
+
+class AudioClock():
+    """Map sample positions of an audio stream to host time.
+
+    The device clock drifts from the host clock, so the host time of the
+    first sample of each chunk is measured and host - device is fitted as a
+    line over device time. Measurements are only delayed by scheduling, never
+    early, so the fit uses the minimum of each window of measurements.
+    """
+
+    def __init__(self, rate, window=1.0, history=300):
+        self.rate = float(rate)
+        # number of frames since the stream started, including lost ones
+        self.position = 0
+        self.lost_frames = 0
+        # delay of the previous chunk if it was captured later than expected by more than a chunk
+        self.late = None
+        # end of the window after lost frames and the least delay seen in it
+        self.settle_end = None
+        self.settle_late = None
+        self.window = window
+        self.window_end = None
+        self.window_min = None
+        self.minima = deque(maxlen=history)
+        # host = device + offset + skew * device
+        self.model = None
+
+    @property
+    def skew(self):
+        return self.model[1] if self.model is not None else 0.0
+
+    @property
+    def offset(self):
+        return self.model[0] if self.model is not None else 0.0
+
+    def add(self, frames, capture_time, overflow=False):
+        """Register a chunk whose first frame was captured at capture_time (host time).
+
+        Return the frame position and the drift compensated host time of the chunk.
+        """
+        device = self.position / self.rate
+        if self.model is not None:
+            late = capture_time - self.to_host(device)
+            if self.settle_end is not None:
+                # lost frames were estimated from a single delayed chunk. the least
+                # delayed chunk of the following window corrects the estimate
+                self.settle_late = min(self.settle_late, late)
+                if device < self.settle_end:
+                    return self.advance(frames, device)
+                correction = int(round(self.settle_late * self.rate))
+                self.lost_frames += correction
+                self.position += correction
+                device = self.position / self.rate
+                self.settle_end = None
+                self.window_min = None
+                self.window_end = device + self.window
+            elif late * self.rate > frames:
+                # lost frames show up as a jump of the capture time by more than a chunk.
+                # the driver does not always flag them, in which case the next chunk has
+                # to be as late to tell them from delayed callbacks catching up
+                if overflow or (self.late is not None and
+                                abs(late - self.late) * self.rate < frames / 2.0):
+                    lost = int(round(late * self.rate))
+                    self.lost_frames += lost
+                    self.position += lost
+                    device = self.position / self.rate
+                    self.settle_end = device + self.window
+                    self.settle_late = capture_time - self.to_host(device)
+                    self.late = None
+                else:
+                    self.late = late
+                # kept out of the fit until lost frames are known
+                return self.advance(frames, device)
+            else:
+                self.late = None
+
+        diff = capture_time - device
+        if self.window_min is None or diff < self.window_min[1]:
+            self.window_min = (device, diff)
+        if self.window_end is None:
+            self.window_end = device + self.window
+            self.model = (diff, 0.0)
+        elif device >= self.window_end:
+            self.minima.append(self.window_min)
+            self.window_min = None
+            self.window_end = device + self.window
+            self.fit()
+
+        return self.advance(frames, device)
+
+    def advance(self, frames, device):
+        position = self.position
+        self.position += frames
+        return position, self.to_host(device)
+
+    def fit(self):
+        if len(self.minima) < 2:
+            self.model = (self.minima[-1][1], 0.0)
+            return
+        device, diff = np.array(self.minima).T
+        skew, offset = np.polyfit(device, diff, 1)
+        self.model = (offset, skew)
+
+    def to_host(self, device):
+        offset, skew = self.model or (0.0, 0.0)
+        return device + offset + skew * device
+
+    def to_device(self, host):
+        offset, skew = self.model or (0.0, 0.0)
+        return (host - offset) / (1.0 + skew)
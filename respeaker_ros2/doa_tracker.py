@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import itertools
+
+import numpy as np
+
+
+def wrap(deg):
+    """Wrap an angle in degrees into [-180, 180)."""
+    return (deg + 180.0) % 360.0 - 180.0
+
+
+class Track():
+    _ids = itertools.count()
+
+    def __init__(self, angle, variance):
+        self.id = next(self._ids)
+        self.angle = angle
+        self.variance = variance
+        self.confidence = 0.0
+
+
+class DoaTracker():
+    """Track the directions of up to max_sources sound sources.
+
+    The device reports a single direction at a time, which jumps between
+    sources talking alternately and jitters by several degrees. Directions
+    observed while voice is active are accumulated in a decaying histogram
+    smoothed with a von Mises kernel, whose mass around a track gives its
+    confidence. Each track filters the observations associated to it with
+    a Kalman filter on the wrapped angle.
+    """
+
+    # decay: histogram decay per update
+    def __init__(self, max_sources=2, bins=72, kappa=30.0, decay=0.95, gate=30.0,
+                 process_noise=20.0, measurement_noise=100.0, min_confidence=0.1):
+        self.max_sources = max_sources
+        self.bin_width = 360.0 / bins
+        self.centers = wrap(np.arange(bins) * self.bin_width)
+        kernel = np.exp(kappa * (np.cos(np.radians(self.centers)) - 1.0))
+        self.kernel = kernel / kernel.sum()
+        self.decay = decay
+        self.gate = gate
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.min_confidence = min_confidence
+        self.histogram = np.zeros(bins)
+        self.tracks = []
+
+    def confidence(self, angle):
+        near = np.abs(wrap(self.centers - angle)) <= self.gate / 2.0
+        # a source observed at every update converges to a mass of 1 / (1 - decay)
+        return min(1.0, self.histogram[near].sum() * (1.0 - self.decay))
+
+    def update(self, doa, is_voice, dt):
+        """Update with a direction in degrees, dt seconds after the previous update.
+
+        Return tracks by descending confidence.
+        """
+        self.histogram *= self.decay
+        for track in self.tracks:
+            track.variance += self.process_noise * dt
+
+        if is_voice:
+            doa = wrap(doa)
+            self.histogram += np.roll(self.kernel, int(round(doa / self.bin_width)))
+            nearest = None
+            if self.tracks:
+                nearest = min(self.tracks, key=lambda t: abs(wrap(doa - t.angle)))
+            if nearest is not None and abs(wrap(doa - nearest.angle)) <= self.gate:
+                gain = nearest.variance / (nearest.variance + self.measurement_noise)
+                nearest.angle = wrap(nearest.angle + gain * wrap(doa - nearest.angle))
+                nearest.variance *= 1.0 - gain
+            elif (len(self.tracks) < self.max_sources and
+                  self.confidence(doa) >= self.min_confidence):
+                self.tracks.append(Track(doa, self.measurement_noise))
+
+        for track in self.tracks:
+            track.confidence = self.confidence(track.angle)
+        self.tracks = [t for t in self.tracks if t.confidence >= self.min_confidence]
+        self.tracks.sort(key=lambda t: -t.confidence)
+        # tracks which converged to the same source are merged into the most confident one
+        merged = []
+        for track in self.tracks:
+            if all(abs(wrap(track.angle - m.angle)) > self.gate / 2.0 for m in merged):
+                merged.append(track)
+        self.tracks = merged
+        return self.tracks
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import wave
+
+import numpy as np
+
+
+def load_template(path, rate):
+    """Load a recorded keyword from a 16 bit WAV file (first channel)."""
+    w = wave.open(path, 'rb')
+    try:
+        if w.getsampwidth() != 2:
+            raise ValueError('%s: only 16 bit WAV files are supported' % path)
+        if w.getframerate() != rate:
+            raise ValueError('%s: sample rate is %d but %d is expected' % (
+                path, w.getframerate(), rate))
+        channels = w.getnchannels()
+        data = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+    finally:
+        w.close()
+    return data.reshape(-1, channels)[:, 0]
+
+
+def mel_filterbank(rate, n_fft, n_mels):
+    def hz2mel(f):
+        return 2595.0 * np.log10(1.0 + f / 700.0)
+
+    def mel2hz(m):
+        return 700.0 * (10.0 ** (m / 2595.0) - 1.0)
+
+    mels = np.linspace(hz2mel(0.0), hz2mel(rate / 2.0), n_mels + 2)
+    bins = np.floor((n_fft + 1) * mel2hz(mels) / rate).astype(int)
+    fb = np.zeros((n_mels, n_fft // 2 + 1), dtype=np.float32)
+    for i in range(n_mels):
+        left, center, right = bins[i], bins[i + 1], bins[i + 2]
+        if center > left:
+            fb[i, left:center] = (np.arange(left, center) - left) / float(center - left)
+        if right > center:
+            fb[i, center:right] = (right - np.arange(center, right)) / float(right - center)
+    return fb
+
+
+def dct_matrix(n_in, n_out):
+    n = np.arange(n_in)
+    k = np.arange(n_out)[:, None]
+    return (np.cos(np.pi * k * (2 * n + 1) / (2.0 * n_in)) *
+            np.sqrt(2.0 / n_in)).astype(np.float32)
+
+
+class MFCC():
+    """Incremental MFCC extractor over a stream of int16 samples."""
+
+    def __init__(self, rate=16000, frame_length=0.025, frame_shift=0.010,
+                 n_fft=512, n_mels=26, n_ceps=13):
+        self.frame_size = int(rate * frame_length)
+        self.hop_size = int(rate * frame_shift)
+        self.n_fft = n_fft
+        self.n_ceps = n_ceps
+        self.window = np.hamming(self.frame_size).astype(np.float32)
+        self.mel_fb = mel_filterbank(rate, n_fft, n_mels).T
+        # c0 only carries the frame energy, which is dropped
+        self.dct = dct_matrix(n_mels, n_ceps)[1:].T
+        self.pending = np.zeros(0, dtype=np.float32)
+
+    def compute(self, samples):
+        """Return MFCCs of all complete frames in samples (not streaming)."""
+        samples = np.asarray(samples, dtype=np.float32)
+        n = 1 + (len(samples) - self.frame_size) // self.hop_size
+        if n <= 0:
+            return np.zeros((0, self.n_ceps - 1), dtype=np.float32)
+        idx = (np.arange(self.frame_size)[None, :] +
+               self.hop_size * np.arange(n)[:, None])
+        power = np.abs(np.fft.rfft(samples[idx] * self.window, self.n_fft)) ** 2
+        return np.log(power.dot(self.mel_fb) + 1e-10).dot(self.dct)
+
+    def feed(self, samples):
+        """Append samples to the stream and return MFCCs of new frames."""
+        buf = np.concatenate((self.pending, np.asarray(samples, dtype=np.float32)))
+        feats = self.compute(buf)
+        self.pending = buf[len(feats) * self.hop_size:]
+        return feats
+
+
+class KeywordSpotter():
+    """Template matching keyword spotter.
+
+    Every live MFCC frame advances a subsequence DTW against each
+    recorded template, so the cost per audio chunk is proportional
+    to the template length only.
+    """
+
+    def __init__(self, templates, rate=16000, threshold=0.35, cmn_decay=0.995):
+        self.mfcc = MFCC(rate=rate)
+        self.threshold = threshold
+        self.cmn_decay = cmn_decay
+        self.templates = []
+        for samples in templates:
+            feats = self.mfcc.compute(samples)
+            if len(feats) < 2:
+                raise ValueError('Keyword template is too short')
+            feats = feats - feats.mean(axis=0)
+            feats /= np.linalg.norm(feats, axis=1, keepdims=True) + 1e-10
+            self.templates.append(feats)
+        if not self.templates:
+            raise ValueError('No keyword template is given')
+        self.mean = None
+        # score of the last detection, kept across reset()
+        self.detected_score = None
+        self.reset()
+
+    def reset(self):
+        # accumulated cost and path length of the best path ending at each template frame
+        self.costs = [np.full(len(t), np.inf) for t in self.templates]
+        self.lengths = [np.ones(len(t)) for t in self.templates]
+        self.score = np.inf
+
+    def process(self, data):
+        """Feed int16 audio bytes. Return True if a keyword ends in them."""
+        detected = False
+        for feat in self.mfcc.feed(np.frombuffer(data, dtype=np.int16)):
+            if self.mean is None:
+                self.mean = feat.copy()
+            else:
+                self.mean *= self.cmn_decay
+                self.mean += (1.0 - self.cmn_decay) * feat
+            feat = feat - self.mean
+            feat /= np.linalg.norm(feat) + 1e-10
+            if self.step(feat):
+                detected = True
+                self.detected_score = self.score
+                self.reset()
+        return detected
+
+    def step(self, feat):
+        best = np.inf
+        for i, template in enumerate(self.templates):
+            cost = 1.0 - template.dot(feat)
+            prev_c, prev_l = self.costs[i], self.lengths[i]
+            # the template advances by 0, 1 or 2 frames per live frame
+            cand_c = np.full((3, len(template)), np.inf)
+            cand_l = np.ones((3, len(template)))
+            cand_c[0], cand_l[0] = prev_c, prev_l
+            cand_c[1, 1:], cand_l[1, 1:] = prev_c[:-1], prev_l[:-1]
+            cand_c[2, 2:], cand_l[2, 2:] = prev_c[:-2], prev_l[:-2]
+            k = np.argmin(cand_c / cand_l, axis=0)
+            cols = np.arange(len(template))
+            new_c = cand_c[k, cols] + cost
+            new_l = cand_l[k, cols] + 1.0
+            # a match may start at any live frame
+            new_c[0], new_l[0] = cost[0], 1.0
+            self.costs[i], self.lengths[i] = new_c, new_l
+            best = min(best, new_c[-1] / new_l[-1])
+        self.score = best
+        return best < self.threshold
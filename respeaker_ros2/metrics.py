@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+import cProfile
+import io
+import pstats
+import threading
+
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+
+# upper bounds of latency buckets in seconds: 10 us .. ~20 s in powers of two
+BUCKETS = [1e-5 * 2 ** i for i in range(22)]
+
+
+class LatencyHistogram():
+    """Histogram of durations with fixed logarithmic buckets.
+
+    record() does not allocate nor lock, which keeps it cheap enough for
+    the audio callback. Concurrent updates may rarely lose a sample.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile."""
+        target = q / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+
+class Metrics():
+    """Counters, gauges and latency histograms grouped by component."""
+
+    def __init__(self):
+        self.components = {}
+
+    def _component(self, component):
+        if component not in self.components:
+            self.components[component] = ({}, {}, {})
+        return self.components[component]
+
+    def counter(self, component, name, value=1):
+        counters = self._component(component)[0]
+        counters[name] = counters.get(name, 0) + value
+
+    def gauge(self, component, name, value):
+        self._component(component)[1][name] = value
+
+    def histogram(self, component, name):
+        histograms = self._component(component)[2]
+        if name not in histograms:
+            histograms[name] = LatencyHistogram()
+        return histograms[name]
+
+    def get(self, component, name, default=0):
+        counters, gauges, _ = self._component(component)
+        return counters.get(name, gauges.get(name, default))
+
+    def to_diagnostics(self, prefix, stamp, warnings=None):
+        """Return DiagnosticArray of all components.
+
+        warnings maps a component to a message to report it with WARN level.
+        """
+        warnings = warnings or {}
+        msg = DiagnosticArray()
+        msg.header.stamp = stamp
+        for component in sorted(self.components):
+            counters, gauges, histograms = self.components[component]
+            status = DiagnosticStatus()
+            status.name = "%s: %s" % (prefix, component)
+            status.hardware_id = prefix
+            if component in warnings:
+                status.level = DiagnosticStatus.WARN
+                status.message = warnings[component]
+            else:
+                status.level = DiagnosticStatus.OK
+                status.message = "OK"
+            for name, value in sorted(counters.items()):
+                status.values.append(KeyValue(key=name, value=str(value)))
+            for name, value in sorted(gauges.items()):
+                status.values.append(KeyValue(key=name, value=str(value)))
+            for name, hist in sorted(histograms.items()):
+                mean = hist.total / hist.count if hist.count else 0.0
+                status.values.append(KeyValue(key=name + " count", value=str(hist.count)))
+                status.values.append(KeyValue(
+                    key=name + " mean [ms]", value="%.3f" % (mean * 1e3)))
+                status.values.append(KeyValue(
+                    key=name + " p99 [ms]", value="%.3f" % (hist.percentile(99) * 1e3)))
+                status.values.append(KeyValue(
+                    key=name + " max [ms]", value="%.3f" % (hist.max * 1e3)))
+            msg.status.append(status)
+        return msg
+
+
+class Profiler():
+    """cProfile hook for hot paths which can be toggled at runtime.
+
+    Since Python 3.12 only one profile can be active at a time in the
+    process, so only one hooked call is profiled at a time, across all
+    Profiler instances. Calls overlapping with it run unprofiled.
+    """
+
+    # held while a call is profiled
+    _active = threading.Lock()
+
+    def __init__(self):
+        self.enabled = False
+        self.profile = None
+
+    def call(self, func, *args):
+        if not self.enabled or not self._active.acquire(blocking=False):
+            return func(*args)
+        try:
+            profile = self.profile
+            if profile is None:
+                # stopped meanwhile
+                return func(*args)
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiling tool is active
+                return func(*args)
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+        finally:
+            self._active.release()
+
+    def start(self):
+        self.profile = cProfile.Profile()
+        self.enabled = True
+
+    def stop(self, path=None, limit=20):
+        """Stop profiling, save the statistics to path and return a summary."""
+        self.enabled = False
+        # wait for a profiled call to finish
+        with self._active:
+            profile, self.profile = self.profile, None
+        if profile is None or not profile.getstats():
+            return "No profile collected"
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        if path:
+            stats.dump_stats(path)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
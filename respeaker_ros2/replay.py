@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Replay recorded audio through the speech segmentation of respeaker_node.
+
+Each multichannel WAV file is cut into chunks of frames_per_buffer frames and
+fed to SpeechSegmenter together with VAD results sampled at update_rate, as the
+node does with a live stream, but as fast as possible.
+
+VAD / DOA results recorded on the device can be given as a CSV file next to
+the WAV file (foo.wav -> foo.csv) with a header and the columns
+time (seconds from the beginning of the WAV file), is_voice and optionally doa.
+Without it, an energy based VAD on the main channel is used instead.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+
+from respeaker_ros2.segmenter import SpeechSegmenter
+
+
+# same defaults as the parameters of RespeakerNode
+DEFAULT_CONFIG = {
+    'update_rate': 10.0,
+    'speech_prefetch': 0.5,
+    'speech_continuation': 0.5,
+    'speech_max_duration': 7.0,
+    'speech_min_duration': 0.1,
+    'speech_chunk_overlap': 0.5,
+    'main_channel': 0,
+    'frames_per_buffer': 1024,
+    # threshold of the energy based VAD in dB above the noise floor
+    'vad_threshold': 10.0,
+}
+
+
+# frames read from WAV files at a time
+BLOCK_FRAMES = 65536
+
+
+def trace_path(path):
+    return os.path.splitext(path)[0] + '.csv'
+
+
+def scan_wav(path, channel, update_rate, energy=True, audio=False):
+    """Read one channel of a 16 bit WAV file block by block.
+
+    Return the number of frames, the sample rate, the energy at each timer
+    tick (see tick_energy) or None and the samples of the channel as bytes
+    or None. Only a block of frames is held in memory besides the results.
+    """
+    w = wave.open(path, 'rb')
+    try:
+        if w.getsampwidth() != 2:
+            raise ValueError('%s: only 16 bit WAV files are supported' % path)
+        channels = w.getnchannels()
+        if not 0 <= channel < channels:
+            raise ValueError('%s: no channel %d in %d channels' % (path, channel, channels))
+        rate = w.getframerate()
+        num_frames = w.getnframes()
+        samples = bytearray() if audio else None
+
+        def blocks():
+            while True:
+                data = w.readframes(BLOCK_FRAMES)
+                if not data:
+                    return
+                block = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)[:, channel]
+                if samples is not None:
+                    samples.extend(block.tobytes())
+                yield block
+
+        if energy:
+            energy = tick_energy(blocks(), num_frames, rate, update_rate)
+        else:
+            energy = None
+            if audio:
+                for _ in blocks():
+                    pass
+    finally:
+        w.close()
+    return num_frames, rate, energy, samples
+
+
+def read_trace(path):
+    """Return times, VAD and DOA (or None) arrays of a recorded trace."""
+    trace = np.genfromtxt(path, delimiter=',', names=True)
+    doa = trace['doa'] if 'doa' in trace.dtype.names else None
+    return trace['time'], trace['is_voice'] > 0, doa
+
+
+def load_trace_vad(path, ticks):
+    times, is_voice, _ = read_trace(path)
+    return sample_trace(times, is_voice, ticks)
+
+
+def tick_times(num_frames, rate, update_rate):
+    return np.arange(0.0, num_frames / float(rate), 1.0 / update_rate)
+
+
+def tick_energy(blocks, num_frames, rate, update_rate):
+    """Energy in dB of the audio in the period just before each timer tick.
+
+    blocks are consecutive int16 arrays of the samples of one channel.
+    """
+    ticks = tick_times(num_frames, rate, update_rate)
+    period = int(rate / update_rate)
+    ends = (ticks * rate).astype(int)
+    starts = np.maximum(ends - period, 0)
+    # cumulative power at the start and the end of each period, exact in int64
+    bounds = np.concatenate((starts, ends))
+    order = np.argsort(bounds, kind='stable')
+    sorted_bounds = bounds[order]
+    cumsum = np.zeros(len(bounds), dtype=np.int64)
+    total, begin, i = 0, 0, 0
+    for block in blocks:
+        block_cumsum = np.concatenate(([0], np.cumsum(block.astype(np.int64) ** 2)))
+        end = begin + len(block)
+        j = np.searchsorted(sorted_bounds, end, side='right')
+        cumsum[order[i:j]] = total + block_cumsum[sorted_bounds[i:j] - begin]
+        total += int(block_cumsum[-1])
+        begin, i = end, j
+    cumsum[order[i:]] = total
+
+    energy = np.full(len(ticks), -np.inf)
+    power = cumsum[len(ticks):] - cumsum[:len(ticks)]
+    valid = ends > starts
+    energy[valid] = 10.0 * np.log10(power[valid] / (ends[valid] - starts[valid]) + 1e-10)
+    return energy
+
+
+def energy_vad(energy, threshold):
+    finite = energy[np.isfinite(energy)]
+    if len(finite) == 0:
+        return np.zeros(len(energy), dtype=bool)
+    noise_floor = np.percentile(finite, 10)
+    return energy > noise_floor + threshold
+
+
+def sample_trace(times, values, ticks):
+    """Value of a recorded trace at each timer tick (last value received before it)."""
+    idx = np.searchsorted(times, ticks, side='right') - 1
+    sampled = values[np.maximum(idx, 0)]
+    if values.dtype == bool:
+        sampled = sampled & (idx >= 0)
+    return sampled
+
+
+def segment(num_frames, rate, vad, config, audio=None):
+    """Run SpeechSegmenter over a stream.
+
+    vad holds the VAD result at each timer tick (see tick_times).
+    audio is the main channel as bytes. Without it only the segment
+    boundaries are computed, which is what parameter tuning needs.
+    """
+    width = 2
+    segmenter = SpeechSegmenter(
+        rate=rate, sample_width=width,
+        prefetch=config['speech_prefetch'],
+        continuation=config['speech_continuation'],
+        min_duration=config['speech_min_duration'],
+        max_duration=config['speech_max_duration'],
+        chunk_overlap=config['speech_chunk_overlap'],
+        keep_audio=audio is not None)
+    chunk = int(config['frames_per_buffer'])
+    period = 1.0 / config['update_rate']
+    if audio is not None:
+        audio = memoryview(audio)
+    else:
+        silence = bytes(chunk * width)
+
+    segments = []
+    tick = 0
+    for begin in range(0, num_frames, chunk):
+        end = min(begin + chunk, num_frames)
+        # the timer runs in between audio callbacks
+        now = end / float(rate)
+        while tick < len(vad) and tick * period < now:
+            seg = segmenter.update(tick * period, vad[tick])
+            if seg is not None:
+                segments.append(seg)
+            tick += 1
+        if audio is not None:
+            segments += segmenter.add_audio(audio[begin * width:end * width])
+        else:
+            segments += segmenter.add_audio(silence[:(end - begin) * width])
+    while tick < len(vad):
+        seg = segmenter.update(tick * period, vad[tick])
+        if seg is not None:
+            segments.append(seg)
+        tick += 1
+    # flush speech which lasts until the end of the file
+    seg = segmenter.update(float('inf'), False)
+    if seg is not None:
+        segments.append(seg)
+    return segments
+
+
+def load_vad(path, num_frames, rate, energy, config):
+    """VAD and DOA (or None) at each timer tick of a WAV file.
+
+    energy (see tick_energy) is used when no trace was recorded.
+    """
+    ticks = tick_times(num_frames, rate, config['update_rate'])
+    if os.path.exists(trace_path(path)):
+        times, is_voice, doa = read_trace(trace_path(path))
+        vad = sample_trace(times, is_voice, ticks)
+        if doa is not None:
+            doa = sample_trace(times, doa, ticks)
+        return vad, doa
+    return energy_vad(energy, config['vad_threshold']), None
+
+
+def circular_mean(degrees):
+    rad = np.radians(degrees)
+    return math.degrees(math.atan2(np.sin(rad).mean(), np.cos(rad).mean()))
+
+
+def replay_file(path, config, output_dir=None):
+    started = time.time()
+    num_frames, rate, energy, audio = scan_wav(
+        path, config['main_channel'], config['update_rate'],
+        energy=not os.path.exists(trace_path(path)), audio=output_dir is not None)
+    vad, doa = load_vad(path, num_frames, rate, energy, config)
+    segments = segment(num_frames, rate, vad, config, audio=audio)
+
+    results = []
+    period = 1.0 / config['update_rate']
+    for i, seg in enumerate(segments):
+        result = {
+            'file': path,
+            'start': seg.start,
+            'end': seg.end,
+            'duration': seg.duration,
+            'accepted': seg.accepted,
+            'utterance': seg.utterance,
+            'index': seg.index,
+            'final': seg.final,
+        }
+        if doa is not None:
+            ticks = slice(int(seg.start / period), int(math.ceil(seg.end / period)) + 1)
+            if len(doa[ticks][vad[ticks]]):
+                result['doa'] = circular_mean(doa[ticks][vad[ticks]])
+        if output_dir is not None and seg.accepted:
+            result['output'] = os.path.join(output_dir, '%s_%03d.wav' % (
+                os.path.splitext(os.path.basename(path))[0], i))
+            w = wave.open(result['output'], 'wb')
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(rate)
+            w.writeframes(seg.data)
+            w.close()
+        results.append(result)
+    return {
+        'file': path,
+        'audio_duration': num_frames / float(rate),
+        'processing_time': time.time() - started,
+        'segments': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+', help='multichannel 16 bit WAV files')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('-o', '--output-dir', help='save accepted segments as WAV files here')
+    for name, default in DEFAULT_CONFIG.items():
+        parser.add_argument('--' + name.replace('_', '-'), dest=name,
+                            type=type(default), default=default)
+    args = parser.parse_args(argv)
+    config = {name: getattr(args, name) for name in DEFAULT_CONFIG}
+
+    started = time.time()
+    audio_duration = 0.0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(replay_file, path, config, args.output_dir) for path in args.files]
+        for future in futures:
+            result = future.result()
+            audio_duration += result['audio_duration']
+            for seg in result['segments']:
+                print(json.dumps(seg))
+            sys.stderr.write('%s: %d segments from %.1f seconds of audio in %.3f seconds\n' % (
+                result['file'], len(result['segments']),
+                result['audio_duration'], result['processing_time']))
+    elapsed = time.time() - started
+    sys.stderr.write('Processed %.1f seconds of audio in %.3f seconds (x%.0f)\n' % (
+        audio_duration, elapsed, audio_duration / max(elapsed, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
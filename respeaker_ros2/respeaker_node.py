@@ -3,7 +3,13 @@
 # Author: furushchev <furushchev@jsk.imi.i.u-tokyo.ac.jp>
 
 import angles
+import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+import glob
+import json
+import threading
 import usb.core
 import usb.util
 import pyaudio
@@ -12,17 +18,25 @@ import numpy as np
 from tf_transformations import quaternion_from_euler
 import os
 import rclpy
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
-from rclpy.duration import Duration
+from rclpy.parameter import Parameter
 from rclpy.time import Time
-from rclpy.clock import ClockType
+from rcl_interfaces.msg import SetParametersResult
 from rclpy.qos import QoSProfile, QoSDurabilityPolicy
 import struct
 import sys
 import time
-from audio_common_msgs.msg import AudioData 
+from audio_common_msgs.msg import AudioData, AudioDataStamped
+from diagnostic_msgs.msg import DiagnosticArray
 from geometry_msgs.msg import PoseStamped
-from std_msgs.msg import Bool, Int32, ColorRGBA
+from std_msgs.msg import Bool, Int32, ColorRGBA, String
+from std_msgs.msg import Float32MultiArray, MultiArrayDimension
+from respeaker_ros2.audio_clock import AudioClock
+from respeaker_ros2.doa_tracker import DoaTracker, wrap
+from respeaker_ros2.keyword_spotter import KeywordSpotter, load_template
+from respeaker_ros2.metrics import Metrics, Profiler
+from respeaker_ros2.segmenter import SpeechSegmenter
 # TODO: check how to replace dynamic reconfigure
 #from dynamic_reconfigure.server import Server
 try:
@@ -62,6 +76,25 @@ def ignore_stderr(enable=True):
         yield
 
 
+def find_alsa_card(bus, address):
+    """
+    find the ALSA card number of the USB audio device at bus/address
+    """
+    for path in glob.glob("/proc/asound/card*/usbbus"):
+        try:
+            with open(path) as f:
+                card_bus, card_address = [int(x) for x in f.read().strip().split("/")]
+        except (IOError, ValueError):
+            continue
+        if (card_bus, card_address) == (bus, address):
+            return int(os.path.basename(os.path.dirname(path))[len("card"):])
+    return None
+
+
+def seconds_to_msg(seconds):
+    return Time(nanoseconds=int(round(seconds * 1e9))).to_msg()
+
+
 # Partly copied from https://github.com/respeaker/usb_4_mic_array
 # parameter list
 # name: (id, offset, type, max, min , r/w, info)
@@ -115,12 +148,19 @@ class RespeakerInterface():
     PRODUCT_ID = 0x0018
     TIMEOUT = 100000
 
-    def __init__(self, logger=None):
-        self.dev = usb.core.find(idVendor=self.VENDOR_ID,
-                                 idProduct=self.PRODUCT_ID)
+    def __init__(self, logger=None, bus=None, address=None, serial=None, metrics=None):
+        self.metrics = metrics or Metrics()
+        self.usb_read_latency = self.metrics.histogram("device", "usb_read")
+        self.usb_write_latency = self.metrics.histogram("device", "usb_write")
+        self.dev = self.find(bus=bus, address=address, serial=serial)
         if not self.dev:
-            raise RuntimeError("Failed to find Respeaker device")
-        logger.info("Initializing Respeaker device (takes 10 seconds)")
+            raise RuntimeError(
+                "Failed to find Respeaker device (bus: %s, address: %s, serial: %s)" % (
+                    bus, address, serial))
+        self.bus = self.dev.bus
+        self.address = self.dev.address
+        logger.info("Initializing Respeaker device at bus %d address %d (takes 10 seconds)" % (
+            self.bus, self.address))
         try:
             self.dev.reset()
         except usb.core.USBError:
@@ -147,6 +187,25 @@ class RespeakerInterface():
         finally:
             self.dev = None
 
+    @classmethod
+    def find(cls, bus=None, address=None, serial=None):
+        for dev in usb.core.find(find_all=True,
+                                 idVendor=cls.VENDOR_ID,
+                                 idProduct=cls.PRODUCT_ID):
+            if bus is not None and dev.bus != bus:
+                continue
+            if address is not None and dev.address != address:
+                continue
+            if serial is not None:
+                try:
+                    dev_serial = usb.util.get_string(dev, dev.iSerialNumber)
+                except (usb.core.USBError, ValueError):
+                    continue
+                if dev_serial != serial:
+                    continue
+            return dev
+        return None
+
     def write(self, name, value):
         try:
             data = PARAMETERS[name]
@@ -164,9 +223,15 @@ class RespeakerInterface():
         else:
             payload = struct.pack(b'ifi', data[1], float(value), 0)
 
-        self.dev.ctrl_transfer(
-            usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
-            0, 0, id, payload, self.TIMEOUT)
+        started = time.perf_counter()
+        try:
+            self.dev.ctrl_transfer(
+                usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
+                0, 0, id, payload, self.TIMEOUT)
+        except usb.core.USBError:
+            self.metrics.counter("device", "usb_errors")
+            raise
+        self.usb_write_latency.record(time.perf_counter() - started)
 
     def read(self, name):
         try:
@@ -182,9 +247,15 @@ class RespeakerInterface():
 
         length = 8
 
-        response = self.dev.ctrl_transfer(
-            usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
-            0, cmd, id, length, self.TIMEOUT)
+        started = time.perf_counter()
+        try:
+            response = self.dev.ctrl_transfer(
+                usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
+                0, cmd, id, length, self.TIMEOUT)
+        except usb.core.USBError:
+            self.metrics.counter("device", "usb_errors")
+            raise
+        self.usb_read_latency.record(time.perf_counter() - started)
 
         response = struct.unpack(b'ii', bytes([x for x in response]))
 
@@ -231,9 +302,19 @@ class RespeakerInterface():
 
 
 class RespeakerAudio():
-    def __init__(self, node, channels=None, suppress_error=True):
+    LOW_LATENCY_FRAMES = 256
+
+    # strict: fail unless the device of the ALSA card is found, instead of using the default input
+    def __init__(self, node, channels=None, suppress_error=True, card=None, pool=None,
+                 strict=False):
         self.on_audio = node.on_audio
-        logger = node.logger
+        self.clock = node.get_clock()
+        self.metrics = node.metrics
+        self.profiler = node.profiler
+        self.callback_latency = self.metrics.histogram("audio", "callback")
+        self.dispatch_latency = self.metrics.histogram("audio", "dispatch")
+        self.capture_delay = self.metrics.histogram("audio", "capture_delay")
+        self.logger = logger = node.logger
         with ignore_stderr(enable=suppress_error):
             self.pyaudio = pyaudio.PyAudio()
         self.available_channels = None
@@ -242,6 +323,21 @@ class RespeakerAudio():
         self.rate = node.declare_parameter("sample_rate", 16000).value
         self.bitwidth = node.declare_parameter("sample_width", 2).value
         self.bitdepth = 16
+        if channels is None:
+            channels = node.declare_parameter("channels", Parameter.Type.INTEGER_ARRAY).value
+        self.channels = channels
+        # frames per callback: smaller blocks lower latency at the cost of more callbacks
+        self.frames_per_buffer = node.declare_parameter("frames_per_buffer", 1024).value
+        if node.declare_parameter("low_latency", False).value:
+            self.frames_per_buffer = min(self.frames_per_buffer, self.LOW_LATENCY_FRAMES)
+        # capture time of each chunk on the ROS clock, compensated for device clock drift
+        self.audio_clock = AudioClock(self.rate)
+        # chunks are handed over to the shared pool, one drain task per stream at a time.
+        # when dispatch falls behind the oldest chunk is dropped, whose gap shows in the stamps
+        self.pool = pool
+        self.pending = deque(maxlen=32)
+        self.pending_lock = threading.Lock()
+        self.draining = False
 
         # find device
         count = self.pyaudio.get_device_count()
@@ -251,27 +347,35 @@ class RespeakerAudio():
             name = info["name"]
             chan = info["maxInputChannels"]
             logger.debug(" - %d: %s" % (i, name))
-            if name.lower().find("respeaker") >= 0:
+            if card is not None:
+                found = name.find("(hw:%d," % card) >= 0
+            else:
+                found = name.lower().find("respeaker") >= 0
+            if found:
                 self.available_channels = chan
                 self.device_index = i
                 logger.info("Found %d: %s (channels: %d)" % (i, name, chan))
                 break
+        if self.device_index is None and strict:
+            raise RuntimeError("Failed to find audio device of ALSA card %s" % card)
         if self.device_index is None:
             logger.warn("Failed to find respeaker device by name. Using default input")
             info = self.pyaudio.get_default_input_device_info()
             self.available_channels = info["maxInputChannels"]
             self.device_index = info["index"]
+        # PyAudio always requests the default low input latency of the device
+        suggested_latency = info["defaultLowInputLatency"]
 
         if self.available_channels != 6:
             logger.warn("%d channel is found for respeaker" % self.available_channels)
             logger.warn("You may have to update firmware.")
         if self.channels is None:
-            self.channels = range(self.available_channels)
+            self.channels = list(range(self.available_channels))
         else:
-            self.channels = filter(lambda c: 0 <= c < self.available_channels, self.channels)
+            self.channels = [c for c in channels if 0 <= c < self.available_channels]
         if not self.channels:
             raise RuntimeError('Invalid channels %s. (Available channels are %s)' % (
-                self.channels, self.available_channels))
+                channels, self.available_channels))
         logger.info('Using channels %s' % self.channels)
 
         self.stream = self.pyaudio.open(
@@ -279,10 +383,18 @@ class RespeakerAudio():
             format=pyaudio.paInt16,
             channels=self.available_channels,
             rate=self.rate,
-            frames_per_buffer=1024,
+            frames_per_buffer=self.frames_per_buffer,
             stream_callback=self.stream_callback,
             input_device_index=self.device_index,
         )
+        input_latency = self.stream.get_input_latency()
+        logger.info(
+            "Capturing %d frames per buffer (%.1f ms), "
+            "input latency %.1f ms (suggested %.1f ms)" % (
+                self.frames_per_buffer, 1e3 * self.frames_per_buffer / self.rate,
+                1e3 * input_latency, 1e3 * suggested_latency))
+        self.metrics.gauge("audio", "frames_per_buffer", self.frames_per_buffer)
+        self.metrics.gauge("audio", "input_latency [ms]", "%.1f" % (1e3 * input_latency))
 
     def __del__(self):
         self.stop()
@@ -298,17 +410,57 @@ class RespeakerAudio():
             pass
 
     def stream_callback(self, in_data, frame_count, time_info, status):
+        started = time.perf_counter()
+        now = self.clock.now().nanoseconds * 1e-9
+        # time_info is on the stream clock: delay from capturing the first frame until now
+        delay = time_info["current_time"] - time_info["input_buffer_adc_time"]
+        if time_info["input_buffer_adc_time"] <= 0 or not 0 <= delay < 1.0:
+            # some host APIs do not report ADC time
+            delay = float(frame_count) / self.rate
+        self.capture_delay.record(delay)
+        overflow = bool(status & pyaudio.paInputOverflow)
+        if overflow:
+            self.metrics.counter("audio", "input_overflows")
+        _, stamp = self.audio_clock.add(frame_count, now - delay, overflow=overflow)
+        if self.pool is None:
+            self.profiler.call(self.dispatch, in_data, stamp)
+            self.callback_latency.record(time.perf_counter() - started)
+            return None, pyaudio.paContinue
+        with self.pending_lock:
+            dropped = len(self.pending) == self.pending.maxlen
+            self.pending.append((in_data, stamp))
+            submit = not self.draining
+            self.draining = True
+        if submit:
+            self.pool.submit(self.drain)
+        if dropped:
+            self.metrics.counter("audio", "dropped_chunks")
+            self.logger.warn("Audio dispatch is falling behind, dropped %d chunks so far" %
+                             self.metrics.get("audio", "dropped_chunks"),
+                             throttle_duration_sec=5.0)
+        self.callback_latency.record(time.perf_counter() - started)
+        return None, pyaudio.paContinue
+
+    def drain(self):
+        while True:
+            with self.pending_lock:
+                if not self.pending:
+                    self.draining = False
+                    return
+                in_data, stamp = self.pending.popleft()
+            self.profiler.call(self.dispatch, in_data, stamp)
+
+    def dispatch(self, in_data, stamp):
+        started = time.perf_counter()
         # split channel
-        data = np.frombuffer(in_data, dtype=np.int16)
-        chunk_per_channel = np.math.ceil(len(data) / self.available_channels)
-        data = np.reshape(data, (chunk_per_channel, self.available_channels))
+        data = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.available_channels)
         for chan in self.channels:
-            chan_data = bytearray(data[:, chan].tobytes())
+            # messages take array.array without checking every byte
+            chan_data = array.array('B', data[:, chan].tobytes())
 
             # invoke callback
-            self.on_audio(chan_data, chan)
-
-        return None, pyaudio.paContinue
+            self.on_audio(chan_data, chan, stamp)
+        self.dispatch_latency.record(time.perf_counter() - started)
 
     def start(self):
         if self.stream.is_stopped():
@@ -320,9 +472,14 @@ class RespeakerAudio():
 
 
 class RespeakerNode(Node):
-    def __init__(self):
-        super().__init__("respeaker_node")
-        
+    def __init__(self, namespace=None, capture_pool=None):
+        super().__init__("respeaker_node", namespace=namespace)
+
+        # select the device by USB bus/address or serial number (-1 / "" for any)
+        usb_bus = self.declare_parameter("usb_bus", -1).value
+        usb_address = self.declare_parameter("usb_address", -1).value
+        usb_serial = self.declare_parameter("usb_serial", "").value
+
         self.update_rate = self.declare_parameter("update_rate", 10.0).value
         self.sensor_frame_id = self.declare_parameter("sensor_frame_id", "respeaker_base").value
         self.doa_xy_offset = self.declare_parameter("doa_xy_offset", 0.0).value
@@ -331,42 +488,125 @@ class RespeakerNode(Node):
         self.speech_continuation = self.declare_parameter("speech_continuation", 0.5).value
         self.speech_max_duration = self.declare_parameter("speech_max_duration", 7.0).value
         self.speech_min_duration = self.declare_parameter("speech_min_duration", 0.1).value
+        # longer speech is published in chunks of speech_max_duration overlapping by this
+        self.speech_chunk_overlap = self.declare_parameter("speech_chunk_overlap", 0.5).value
         self.main_channel = self.declare_parameter('main_channel', 0).value
+        # smooth DOA and publish it only when it changes by doa_min_change degrees
+        doa_tracking = self.declare_parameter("doa_tracking", True).value
+        doa_max_sources = self.declare_parameter("doa_max_sources", 2).value
+        self.doa_min_change = self.declare_parameter("doa_min_change", 5.0).value
+        self.doa_min_confidence_change = self.declare_parameter(
+            "doa_min_confidence_change", 0.1).value
         suppress_pyaudio_error = self.declare_parameter("suppress_pyaudio_error", True).value
+        # forward speech to speech_audio only after a keyword is spotted
+        keyword_spotting = self.declare_parameter("keyword_spotting", False).value
+        keyword_templates = self.declare_parameter(
+            "keyword_templates", Parameter.Type.STRING_ARRAY).value or []
+        keyword_threshold = self.declare_parameter("keyword_threshold", 0.35).value
+        self.keyword_timeout = self.declare_parameter("keyword_timeout", 3.0).value
+        # publish metrics on /diagnostics at this rate (0 to disable)
+        diagnostics_rate = self.declare_parameter("diagnostics_rate", 1.0).value
+        # profile the audio and timer callbacks while true, saving to profiling_output if set
+        profiling = self.declare_parameter("profiling", False).value
+        self.profiling_output = self.declare_parameter("profiling_output", "").value
         
         self.logger = self.get_logger()
-        self.respeaker = RespeakerInterface(logger=self.logger)
-        self.respeaker_audio = RespeakerAudio(self, suppress_error=suppress_pyaudio_error)
-        self.speech_audio_buffer = bytearray()
-        self.is_speeching = False
-        self.speech_stopped = Time(clock_type=ClockType.ROS_TIME)
+        self.metrics = Metrics()
+        self.profiler = Profiler()
+        if profiling:
+            self.profiler.start()
+        self.prev_overflows = 0
+        self.prev_dropped = 0
+        self.respeaker = RespeakerInterface(
+            metrics=self.metrics,
+            logger=self.logger,
+            bus=usb_bus if usb_bus >= 0 else None,
+            address=usb_address if usb_address >= 0 else None,
+            serial=usb_serial or None)
+        # a selected device or one of several arrays must not fall back to another input
+        strict = (usb_bus >= 0 or usb_address >= 0 or bool(usb_serial) or
+                  namespace is not None)
+        card = find_alsa_card(self.respeaker.bus, self.respeaker.address)
+        if card is None and strict:
+            raise RuntimeError("Failed to find ALSA card of bus %d address %d" % (
+                self.respeaker.bus, self.respeaker.address))
+        if card is None:
+            self.logger.warn("Failed to find ALSA card of bus %d address %d" % (
+                self.respeaker.bus, self.respeaker.address))
+        self.respeaker_audio = RespeakerAudio(
+            self, suppress_error=suppress_pyaudio_error, card=card, pool=capture_pool,
+            strict=strict)
+        if self.main_channel not in self.respeaker_audio.channels:
+            raise RuntimeError("main_channel %d is not captured (channels: %s)" % (
+                self.main_channel, self.respeaker_audio.channels))
+        self.publish_latency = self.metrics.histogram("audio", "capture_to_publish")
+        self.segmenter = SpeechSegmenter(
+            rate=self.respeaker_audio.rate,
+            sample_width=self.respeaker_audio.bitwidth,
+            prefetch=self.speech_prefetch,
+            continuation=self.speech_continuation,
+            min_duration=self.speech_min_duration,
+            max_duration=self.speech_max_duration,
+            chunk_overlap=self.speech_chunk_overlap)
+        # add_audio and update are called from the audio and timer threads
+        self.segmenter_lock = threading.Lock()
+        self.speech_passed = False
+        self.keyword_spotter = None
+        self.keyword_stamp = None
+        self.keyword_hits = 0
+        self.keyword_misses = 0
+        if keyword_spotting:
+            self.keyword_spotter = KeywordSpotter(
+                [load_template(path, self.respeaker_audio.rate) for path in keyword_templates],
+                rate=self.respeaker_audio.rate, threshold=keyword_threshold)
+            self.logger.info("Keyword spotting enabled with %d templates" % len(keyword_templates))
         self.prev_is_voice = None
         self.prev_doa = None
+        self.doa_tracker = None
+        self.prev_tracks = {}
+        self.prev_primary = None
+        if doa_tracking:
+            self.doa_tracker = DoaTracker(max_sources=doa_max_sources)
         # advertise
         latching_qos = QoSProfile(depth=1,
             durability=QoSDurabilityPolicy.TRANSIENT_LOCAL)
         self.pub_vad = self.create_publisher(Bool, "is_speeching", qos_profile=latching_qos)
         self.pub_doa_raw = self.create_publisher(Int32, "sound_direction", qos_profile=latching_qos)
         self.pub_doa = self.create_publisher(PoseStamped, "sound_localization", qos_profile=latching_qos)
+        # id, direction and confidence of each tracked source
+        self.pub_sources = self.create_publisher(
+            Float32MultiArray, "sound_sources", qos_profile=latching_qos)
         
         self.pub_audio = self.create_publisher(AudioData, "audio", 10)
         self.pub_speech_audio = self.create_publisher(AudioData, "speech_audio", 10)
+        # stamped with the capture time of the first sample
+        self.pub_audio_stamped = self.create_publisher(AudioDataStamped, "audio_stamped", 10)
+        self.pub_speech_audio_stamped = self.create_publisher(
+            AudioDataStamped, "speech_audio_stamped", 10)
+        # utterance id, chunk index and final flag of each speech_audio message
+        self.pub_speech_info = self.create_publisher(String, "speech_audio_info", 10)
         self.pub_audios = {c:self.create_publisher(AudioData, 'audio/channel%d' % c, 10) for c in self.respeaker_audio.channels}
         # init config
         self.config = None
         # TODO: check how to replace dynamic reconfigure
         #self.dyn_srv = Server(RespeakerConfig, self.on_config)
         # start
-        self.speech_prefetch_bytes = int(
-            self.speech_prefetch * self.respeaker_audio.rate * self.respeaker_audio.bitdepth / 8.0)
-        self.speech_prefetch_buffer = bytearray()
         self.respeaker_audio.start()
         self.info_timer = self.create_timer(1.0/self.update_rate,
-                                      self.on_timer)
+                                      lambda: self.profiler.call(self.on_timer))
+        self.timer_latency = self.metrics.histogram("device", "timer")
+        self.pub_diagnostics = None
+        if diagnostics_rate > 0:
+            self.pub_diagnostics = self.create_publisher(DiagnosticArray, "/diagnostics", 1)
+            self.diagnostics_timer = self.create_timer(1.0 / diagnostics_rate, self.on_diagnostics)
+        self.add_on_set_parameters_callback(self.on_set_parameters)
         self.timer_led = None
         self.sub_led = self.create_subscription(ColorRGBA, "status_led", self.on_status_led, 1)
 
     def on_shutdown(self):
+        if self.profiler.enabled:
+            self.logger.info(
+                "Stop profiling\n%s" % self.profiler.stop(self.profiling_output or None))
         try:
             self.respeaker.close()
         except:
@@ -394,6 +634,38 @@ class RespeakerNode(Node):
         self.config = config
         return config
 
+    def on_set_parameters(self, params):
+        for param in params:
+            if param.name == "profiling_output":
+                self.profiling_output = param.value
+            elif param.name == "profiling" and param.value and not self.profiler.enabled:
+                self.logger.info("Start profiling")
+                self.profiler.start()
+            elif param.name == "profiling" and not param.value and self.profiler.enabled:
+                self.logger.info(
+                    "Stop profiling\n%s" % self.profiler.stop(self.profiling_output or None))
+        return SetParametersResult(successful=True)
+
+    def on_diagnostics(self):
+        audio_clock = self.respeaker_audio.audio_clock
+        self.metrics.gauge("audio", "clock_skew [ppm]", "%.1f" % (audio_clock.skew * 1e6))
+        self.metrics.gauge("audio", "clock_offset [s]", "%.6f" % audio_clock.offset)
+        self.metrics.gauge("audio", "lost_frames", audio_clock.lost_frames)
+        warnings = {}
+        overflows = self.metrics.get("audio", "input_overflows")
+        dropped = self.metrics.get("audio", "dropped_chunks")
+        problems = []
+        if overflows > self.prev_overflows:
+            problems.append("%d input overflows" % (overflows - self.prev_overflows))
+        if dropped > self.prev_dropped:
+            problems.append("%d dropped chunks" % (dropped - self.prev_dropped))
+        if problems:
+            warnings["audio"] = ", ".join(problems)
+        self.prev_overflows = overflows
+        self.prev_dropped = dropped
+        self.pub_diagnostics.publish(self.metrics.to_diagnostics(
+            self.get_fully_qualified_name(), self.get_clock().now().to_msg(), warnings))
+
     def on_status_led(self, msg):
         self.respeaker.set_led_color(r=msg.r, g=msg.g, b=msg.b, a=msg.a)
         if self.timer_led and self.timer_led.is_alive():
@@ -404,24 +676,36 @@ class RespeakerNode(Node):
         #                                lambda e: self.respeaker.set_led_trace(),
         #                                oneshot=True)
 
-    def on_audio(self, data, channel):
+    def on_audio(self, data, channel, stamp):
         self.pub_audios[channel].publish(AudioData(data=data))
         if channel == self.main_channel:
             self.pub_audio.publish(AudioData(data=data))
-            if self.is_speeching:
-                if len(self.speech_audio_buffer) == 0:
-                    self.speech_audio_buffer = self.speech_prefetch_buffer
-                for x in data:
-                    self.speech_audio_buffer += bytearray([x])
-            else:
-                for x in data:
-                    self.speech_prefetch_buffer += bytearray([x])
-                self.speech_prefetch_buffer = self.speech_prefetch_buffer[-self.speech_prefetch_bytes:]
+            msg = AudioDataStamped()
+            msg.header.frame_id = self.sensor_frame_id
+            msg.header.stamp = seconds_to_msg(stamp)
+            msg.audio.data = data
+            self.pub_audio_stamped.publish(msg)
+            self.publish_latency.record(self.get_clock().now().nanoseconds * 1e-9 - stamp)
+            if self.keyword_spotter is not None and self.keyword_spotter.process(data):
+                self.keyword_stamp = stamp
+                self.metrics.counter("keyword", "detections")
+                self.logger.info(
+                    "Keyword detected (score: %.3f)" % self.keyword_spotter.detected_score)
+            # publishing under the lock keeps chunks and segments in order
+            with self.segmenter_lock:
+                for chunk in self.segmenter.add_audio(data, stamp):
+                    self.publish_speech(chunk)
 
     def on_timer(self):
-        stamp = self.get_clock().now()
+        started = time.perf_counter()
+        before = self.get_clock().now()
         is_voice = self.respeaker.is_voice()
-        doa_rad = math.radians(self.respeaker.direction - 180.0)
+        direction = self.respeaker.direction
+        after = self.get_clock().now()
+        # stamp device state at the middle of the USB transfers, on the same clock as audio
+        stamp = Time(nanoseconds=(before.nanoseconds + after.nanoseconds) // 2,
+                     clock_type=before.clock_type)
+        doa_rad = math.radians(direction - 180.0)
         doa_rad = angles.shortest_angular_distance(
             doa_rad, math.radians(self.doa_yaw_offset))
         doa = math.degrees(doa_rad)
@@ -432,48 +716,152 @@ class RespeakerNode(Node):
             self.prev_is_voice = is_voice
 
         # doa
-        if doa != self.prev_doa:
-            self.pub_doa_raw.publish(Int32(data=int(doa)))
+        if self.doa_tracker is not None:
+            tracks = self.doa_tracker.update(doa, is_voice, 1.0 / self.update_rate)
+            self.publish_tracks(tracks, stamp)
+        elif doa != self.prev_doa:
+            self.publish_doa(doa, stamp)
             self.prev_doa = doa
 
-            msg = PoseStamped()
-            msg.header.frame_id = self.sensor_frame_id
-            msg.header.stamp = stamp.to_msg()
-            ori = quaternion_from_euler(math.radians(doa), 0, 0)
-            msg.pose.position.x = self.doa_xy_offset * np.cos(doa_rad)
-            msg.pose.position.y = self.doa_xy_offset * np.sin(doa_rad)
-            msg.pose.orientation.w = ori[0]
-            msg.pose.orientation.x = ori[1]
-            msg.pose.orientation.y = ori[2]
-            msg.pose.orientation.z = ori[3]
-            self.pub_doa.publish(msg)
-
         # speech audio
-        if is_voice:
-            self.speech_stopped = stamp
-        if ((stamp - self.speech_stopped) < Duration(seconds=self.speech_continuation)):
-            self.is_speeching = True
-        elif self.is_speeching:
-            buf = self.speech_audio_buffer
-            self.speech_audio_buffer = bytearray()
-            self.is_speeching = False
-            duration = len(buf) * self.respeaker_audio.bitwidth * 8.0 
-            duration = duration / self.respeaker_audio.rate / self.respeaker_audio.bitdepth
-            self.logger.info("Speech detected for %.3f seconds" % duration)
-            if self.speech_min_duration <= duration < self.speech_max_duration:
-                self.pub_speech_audio.publish(AudioData(data=list(buf)))
+        with self.segmenter_lock:
+            segment = self.segmenter.update(stamp.nanoseconds * 1e-9, is_voice)
+            if segment is not None:
+                self.publish_speech(segment)
+        self.timer_latency.record(time.perf_counter() - started)
+
+    def publish_doa(self, doa, stamp):
+        self.metrics.counter("doa", "published")
+        self.pub_doa_raw.publish(Int32(data=int(doa)))
+
+        doa_rad = math.radians(doa)
+        msg = PoseStamped()
+        msg.header.frame_id = self.sensor_frame_id
+        msg.header.stamp = stamp.to_msg()
+        ori = quaternion_from_euler(doa_rad, 0, 0)
+        msg.pose.position.x = self.doa_xy_offset * np.cos(doa_rad)
+        msg.pose.position.y = self.doa_xy_offset * np.sin(doa_rad)
+        msg.pose.orientation.w = ori[0]
+        msg.pose.orientation.x = ori[1]
+        msg.pose.orientation.y = ori[2]
+        msg.pose.orientation.z = ori[3]
+        self.pub_doa.publish(msg)
+
+    def publish_tracks(self, tracks, stamp):
+        # the most confident source is published as the sound direction
+        if tracks:
+            primary = tracks[0]
+            if (self.prev_primary is None or primary.id != self.prev_primary[0] or
+                    abs(wrap(primary.angle - self.prev_primary[1])) >= self.doa_min_change):
+                self.publish_doa(primary.angle, stamp)
+                self.prev_primary = (primary.id, primary.angle)
+
+        changed = set(t.id for t in tracks) != set(self.prev_tracks)
+        for track in tracks:
+            if changed:
+                break
+            angle, confidence = self.prev_tracks[track.id]
+            changed = (abs(wrap(track.angle - angle)) >= self.doa_min_change or
+                       abs(track.confidence - confidence) >= self.doa_min_confidence_change)
+        if not changed:
+            return
+        self.prev_tracks = {t.id: (t.angle, t.confidence) for t in tracks}
+        msg = Float32MultiArray()
+        msg.layout.dim = [
+            MultiArrayDimension(label="sources", size=len(tracks), stride=3 * len(tracks)),
+            MultiArrayDimension(label="id_direction_confidence", size=3, stride=3),
+        ]
+        msg.data = [float(x) for t in tracks for x in (t.id, t.angle, t.confidence)]
+        self.pub_sources.publish(msg)
+        self.metrics.counter("doa", "sources_published")
+        self.metrics.gauge("doa", "sources", len(tracks))
+
+    def publish_speech(self, segment):
+        # called with segmenter_lock held
+        if segment.index == 0:
+            self.speech_passed = segment.accepted and self.keyword_gate(segment.started)
+            if not segment.accepted:
+                self.metrics.counter("speech", "dropped_duration")
+        self.metrics.counter("speech", "utterances" if segment.final else "chunks")
+        if segment.final and segment.index == 0:
+            self.logger.info("Speech detected for %.3f seconds" % segment.duration)
+        else:
+            self.logger.info("Speech chunk %d of utterance %d for %.3f seconds%s" % (
+                segment.index, segment.utterance, segment.duration,
+                " (final)" if segment.final else ""))
+        if not self.speech_passed:
+            return
+        # capture time of the first frame, which lost audio does not shift
+        stamp = segment.stamp
+        data = array.array('B', segment.data)
+        self.pub_speech_info.publish(String(data=json.dumps({
+            "utterance_id": segment.utterance,
+            "index": segment.index,
+            "final": segment.final,
+            "stamp": stamp,
+            "duration": segment.duration,
+            "size": len(data),
+        })))
+        self.pub_speech_audio.publish(AudioData(data=data))
+        msg = AudioDataStamped()
+        msg.header.frame_id = self.sensor_frame_id
+        msg.header.stamp = seconds_to_msg(stamp)
+        msg.audio.data = data
+        self.pub_speech_audio_stamped.publish(msg)
+
+    def keyword_gate(self, started):
+        if self.keyword_spotter is None:
+            return True
+        # the keyword may be part of the segment itself or precede it
+        since = started - self.speech_prefetch - self.keyword_timeout
+        if self.keyword_stamp is not None and self.keyword_stamp >= since:
+            self.keyword_hits += 1
+            passed = True
+        else:
+            self.keyword_misses += 1
+            passed = False
+        self.metrics.gauge("keyword", "hits", self.keyword_hits)
+        self.metrics.gauge("keyword", "misses", self.keyword_misses)
+        self.metrics.gauge("keyword", "suppressed [%]", "%.1f" % (
+            100.0 * self.keyword_misses / (self.keyword_hits + self.keyword_misses)))
+        self.logger.info("Keyword gate: %d hits, %d misses (%.1f%% of segments suppressed)" % (
+            self.keyword_hits, self.keyword_misses,
+            100.0 * self.keyword_misses / (self.keyword_hits + self.keyword_misses)))
+        return passed
 
 
 def main():
     rclpy.init()
-    respeaker_node = RespeakerNode()
+    # namespaces of the arrays hosted by this process, e.g. ['front', 'back']
+    manager = Node("respeaker_manager")
+    arrays = manager.declare_parameter("arrays", Parameter.Type.STRING_ARRAY).value or []
+    manager.destroy_node()
+
+    capture_pool = None
+    if len(arrays) > 1:
+        capture_pool = ThreadPoolExecutor(max_workers=len(arrays),
+                                          thread_name_prefix="respeaker_capture")
+    respeaker_nodes = []
+    executor = MultiThreadedExecutor()
     try:
-        rclpy.spin(respeaker_node)
+        if arrays:
+            for namespace in arrays:
+                respeaker_nodes.append(
+                    RespeakerNode(namespace=namespace, capture_pool=capture_pool))
+        else:
+            respeaker_nodes.append(RespeakerNode())
+        for respeaker_node in respeaker_nodes:
+            executor.add_node(respeaker_node)
+        executor.spin()
     except KeyboardInterrupt:
         pass
     finally:
-        respeaker_node.on_shutdown()  # do any custom cleanup
-        respeaker_node.destroy_node()
+        for respeaker_node in respeaker_nodes:
+            respeaker_node.on_shutdown()  # do any custom cleanup
+            respeaker_node.destroy_node()
+        if capture_pool is not None:
+            capture_pool.shutdown(wait=False)
+        executor.shutdown()
         rclpy.shutdown()
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque, namedtuple
+
+
+# start / end: position in the audio stream in seconds
+# stamp: capture time of the first sample, from the stamps given to add_audio()
+# started: time given to update() when the speech started
+# accepted: whether the speech lasts at least min_duration
+# utterance / index / final: speech longer than max_duration is split into
+# overlapping chunks of the same utterance, the last one being final
+Segment = namedtuple('Segment', ['start', 'end', 'duration', 'stamp', 'started', 'accepted',
+                                 'data', 'utterance', 'index', 'final'])
+
+
+class SpeechSegmenter():
+    """Cut speech segments out of the main channel based on periodic VAD results.
+
+    This holds the segmentation logic of RespeakerNode without depending on ROS,
+    so that it can be run offline. Time is given by the caller of update(), in seconds.
+    """
+
+    def __init__(self, rate=16000, sample_width=2, prefetch=0.5, continuation=0.5,
+                 min_duration=0.1, max_duration=7.0, chunk_overlap=0.5, keep_audio=True):
+        self.rate = rate
+        self.sample_width = sample_width
+        self.bytes_per_second = float(rate * sample_width)
+        self.continuation = continuation
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        # the buffer never grows beyond max_bytes
+        max_frames = max(int(max_duration * rate), 1)
+        self.max_bytes = max_frames * sample_width
+        overlap_frames = min(int(chunk_overlap * rate), max_frames // 2)
+        self.overlap_bytes = overlap_frames * sample_width
+        # the prefetch has to fit in the first chunk next to new audio
+        self.prefetch_bytes = min(int(prefetch * rate), max_frames - overlap_frames) * sample_width
+        # without audio only the sizes are tracked, e.g. for parameter tuning
+        self.keep_audio = keep_audio
+        self.prefetch_buffer = bytearray()
+        self.prefetch_size = 0
+        self.buffer = bytearray()
+        self.buffer_size = 0
+        self.position = 0
+        self.segment_start = 0
+        # (position, stamp) of the chunks of audio still buffered
+        self.stamps = deque()
+        self.utterance = 0
+        self.index = 0
+        self.is_speeching = False
+        self.speech_started = None
+        self.speech_stopped = None
+
+    def add_audio(self, data, stamp=None):
+        """Append audio captured at stamp. Return chunks of speech which reached max_duration.
+
+        Audio lost before data, as seen from its stamp, is filled with silence
+        so that segments keep their real duration.
+        """
+        size = len(data)
+        chunks = []
+        if stamp is not None:
+            gap = self.gap_before(stamp, size)
+            if gap:
+                chunks += self.add_audio(bytes(gap))
+            self.stamps.append((self.position, stamp))
+        if self.is_speeching:
+            if self.buffer_size == 0 and self.index == 0:
+                self.segment_start = self.position - self.prefetch_size
+                self.buffer, self.buffer_size = self.prefetch_buffer, self.prefetch_size
+                self.prefetch_buffer, self.prefetch_size = bytearray(), 0
+            offset = 0
+            while self.buffer_size + size - offset > self.max_bytes:
+                end = offset + self.max_bytes - self.buffer_size
+                if self.keep_audio:
+                    self.buffer += data[offset:end]
+                self.buffer_size = self.max_bytes
+                chunks.append(self.pop(final=False))
+                offset = end
+            if self.keep_audio:
+                self.buffer += data[offset:]
+            self.buffer_size += size - offset
+        else:
+            self.prefetch_size = min(self.prefetch_size + size, self.prefetch_bytes)
+            if self.keep_audio:
+                self.prefetch_buffer += data
+                del self.prefetch_buffer[:len(self.prefetch_buffer) - self.prefetch_size]
+        self.position += size
+        # keep the stamp of the chunk holding the first buffered byte
+        first = self.segment_start if self.is_speeching else self.position - self.prefetch_size
+        while len(self.stamps) > 1 and self.stamps[1][0] <= first:
+            self.stamps.popleft()
+        return chunks
+
+    def gap_before(self, stamp, size):
+        """Size of the audio missing before a chunk of size bytes captured at stamp."""
+        expected = self.stamp_at(self.position)
+        if expected is None or stamp - expected < 0.5 * size / self.bytes_per_second:
+            # jitter of the stamps is far below a chunk
+            return 0
+        frames = int(round((stamp - expected) * self.rate))
+        return min(frames * self.sample_width, self.max_bytes)
+
+    def stamp_at(self, position):
+        if not self.stamps:
+            return None
+        for chunk_position, stamp in reversed(self.stamps):
+            if chunk_position <= position:
+                break
+        return stamp + (position - chunk_position) / self.bytes_per_second
+
+    def update(self, stamp, is_voice):
+        """Update VAD state at time stamp. Return a Segment when a speech ends."""
+        if is_voice:
+            self.speech_stopped = stamp
+        if self.speech_stopped is not None and stamp - self.speech_stopped < self.continuation:
+            if not self.is_speeching:
+                self.speech_started = stamp
+            self.is_speeching = True
+            return None
+        if not self.is_speeching:
+            return None
+        self.is_speeching = False
+        return self.pop(final=True)
+
+    def pop(self, final):
+        data, size = self.buffer, self.buffer_size
+        start = self.segment_start / self.bytes_per_second
+        duration = size / self.bytes_per_second
+        if self.index > 0:
+            # the rest of a long utterance is always passed on to finish it
+            accepted = True
+        else:
+            # longer speech is split into chunks, so only the minimum applies
+            accepted = not final or self.min_duration <= duration
+        segment = Segment(
+            start=start, end=start + duration, duration=duration,
+            stamp=self.stamp_at(self.segment_start),
+            started=self.speech_started, accepted=accepted,
+            data=bytes(data) if self.keep_audio else None,
+            utterance=self.utterance, index=self.index, final=final)
+        if final:
+            self.buffer, self.buffer_size = bytearray(), 0
+            self.utterance += 1
+            self.index = 0
+        else:
+            # the next chunk starts with the end of this one
+            if self.keep_audio:
+                self.buffer = self.buffer[size - self.overlap_bytes:]
+            self.buffer_size = self.overlap_bytes
+            self.segment_start += size - self.overlap_bytes
+            self.index += 1
+        return segment
@@ -2,6 +2,10 @@
 # -*- coding: utf-8 -*-
 # Author: Yuki Furuta <furushchev@jsk.imi.i.u-tokyo.ac.jp>
 
+from collections import OrderedDict
+import json
+import time
+
 import rclpy
 from rclpy.node import Node
 from rclpy.action import ActionClient
@@ -10,9 +14,31 @@ from rclpy.duration import Duration
 import speech_recognition as SR
 
 from actionlib_msgs.msg import GoalStatus
-from audio_common_msgs.msg import AudioData
+from audio_common_msgs.msg import AudioData, AudioDataStamped
+from diagnostic_msgs.msg import DiagnosticArray
 from sound_play_msgs.action import SoundRequest as SoundRequestAction
 from speech_recognition_msgs.msg import SpeechRecognitionCandidates
+from std_msgs.msg import String
+
+from respeaker_ros2.metrics import Metrics
+
+
+def join_transcripts(transcripts):
+    """Join transcripts of overlapping chunks of an utterance.
+
+    Words at the start of a chunk which repeat the end of the previous
+    transcript were recognized from the overlapping audio and are dropped.
+    """
+    words = []
+    for transcript in transcripts:
+        new = transcript.split()
+        lowered = [w.lower() for w in new]
+        for n in range(min(len(words), len(new)), 0, -1):
+            if [w.lower() for w in words[-n:]] == lowered[:n]:
+                new = new[n:]
+                break
+        words += new
+    return " ".join(words)
 
 
 class SpeechToText(Node):
@@ -32,7 +58,16 @@ class SpeechToText(Node):
         # time to assume as SPEAKING after tts service is finished
         self.tts_tolerance = Duration(seconds=self.declare_parameter("tts_tolerance", 1.0).value)
 
+        # join chunks of long utterances from speech_audio_stamped and speech_audio_info
+        # of respeaker_node instead of recognizing each speech_audio message on its own
+        self.speech_chunks = self.declare_parameter("speech_chunks", False).value
+
+        # publish metrics on /diagnostics at this rate (0 to disable)
+        diagnostics_rate = self.declare_parameter("diagnostics_rate", 1.0).value
+
         self.recognizer = SR.Recognizer()
+        self.metrics = Metrics()
+        self.request_latency = self.metrics.histogram("recognition", "request")
 
         self.tts_action = None
         self.last_tts = None
@@ -46,8 +81,30 @@ class SpeechToText(Node):
                 self.get_logger().error("action sound_play is not initialized.")
                 self.tts_action = None
 
+        # chunks of long utterances are recognized one by one and published together.
+        # info and audio come on separate topics and are paired by the audio stamp
+        self.speech_infos = OrderedDict()
+        self.speech_audios = OrderedDict()
+        self.utterance_id = None
+        self.transcripts = []
+        self.confidences = []
+
         self.pub_speech = self.create_publisher(SpeechRecognitionCandidates, "speech_to_text", 1)
-        self.sub_audio = self.create_subscription(AudioData, "speech_audio", self.audio_cb, 1)
+        if self.speech_chunks:
+            self.sub_speech_info = self.create_subscription(
+                String, "speech_audio_info", self.speech_info_cb, 10)
+            self.sub_audio = self.create_subscription(
+                AudioDataStamped, "speech_audio_stamped", self.audio_cb, 10)
+        else:
+            self.sub_audio = self.create_subscription(
+                AudioData, "speech_audio", self.single_audio_cb, 10)
+        if diagnostics_rate > 0:
+            self.pub_diagnostics = self.create_publisher(DiagnosticArray, "/diagnostics", 1)
+            self.diagnostics_timer = self.create_timer(1.0 / diagnostics_rate, self.diagnostics_cb)
+
+    def diagnostics_cb(self):
+        self.pub_diagnostics.publish(self.metrics.to_diagnostics(
+            self.get_fully_qualified_name(), self.get_clock().now().to_msg()))
 
     def tts_timer_cb(self):
         stamp = self.get_clock().now()
@@ -68,25 +125,68 @@ class SpeechToText(Node):
         #         self.get_logger().debug("END CANCELLATION")
         #         self.is_canceling = False
 
+    def speech_info_cb(self, msg):
+        info = json.loads(msg.data)
+        # same rounding as the header stamp of the audio
+        key = int(round(info["stamp"] * 1e9))
+        if key in self.speech_audios:
+            self.recognize(self.speech_audios.pop(key), info)
+        else:
+            self.keep(self.speech_infos, key, info, "info")
+
     def audio_cb(self, msg):
+        key = msg.header.stamp.sec * 1000000000 + msg.header.stamp.nanosec
+        if key in self.speech_infos:
+            self.recognize(msg.audio, self.speech_infos.pop(key))
+        else:
+            self.keep(self.speech_audios, key, msg.audio, "audio")
+
+    def single_audio_cb(self, msg):
+        self.recognize(msg, {"utterance_id": None, "index": 0, "final": True})
+
+    def keep(self, pending, key, value, kind, limit=10):
+        pending[key] = value
+        while len(pending) > limit:
+            pending.popitem(last=False)
+            self.metrics.counter("recognition", "unpaired_chunks")
+            self.get_logger().warn("Dropped speech %s which was not paired" % kind)
+
+    def recognize(self, msg, info):
         # if self.is_canceling:
         #     self.get_logger().info("Speech is cancelled")
         #     return
         data = SR.AudioData(bytes(msg.data), self.sample_rate, self.sample_width)
-
+        if info["index"] == 0 or info["utterance_id"] != self.utterance_id:
+            self.utterance_id = info["utterance_id"]
+            self.transcripts = []
+            self.confidences = []
+
+        self.metrics.counter("recognition", "requests")
+        self.metrics.counter("recognition", "audio_bytes", len(msg.data))
+        started = time.perf_counter()
         try:
             self.get_logger().info("Waiting for result %d" % len(data.get_raw_data()))
             result, confidence = self.recognizer.recognize_google(
                 data, language=self.language, show_all=False, with_confidence=True)
-
-            msg = SpeechRecognitionCandidates(transcript=[result], confidence=[confidence])
-            self.pub_speech.publish(msg)
+            self.transcripts.append(result)
+            self.confidences.append(confidence)
         except SR.UnknownValueError as e:
+            self.metrics.counter("recognition", "unknown_value_errors")
             self.get_logger().error("Failed to recognize: %s" % str(e))
             self.get_logger().info("value error")
         except SR.RequestError as e:
+            self.metrics.counter("recognition", "request_errors")
             self.get_logger().error("Failed to recognize: %s" % str(e))
             self.get_logger().info("request error")
+        self.request_latency.record(time.perf_counter() - started)
+
+        if info["final"] and self.transcripts:
+            msg = SpeechRecognitionCandidates(
+                transcript=[join_transcripts(self.transcripts)],
+                confidence=[sum(self.confidences) / len(self.confidences)])
+            self.pub_speech.publish(msg)
+            self.transcripts = []
+            self.confidences = []
 
 
 def main():
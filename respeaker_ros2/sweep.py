@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Search speech segmentation parameters of respeaker_node on a labeled corpus.
+
+Each WAV file needs a label file next to it (foo.wav -> foo.txt) in the format
+of Audacity label tracks: one utterance per line as start<TAB>end[<TAB>text]
+in seconds. VAD is taken from recorded traces (foo.csv, see respeaker_replay)
+or computed by the energy based VAD, whose threshold is then searched too.
+
+Configurations are scored by boundary error, truncation rate and false
+segment rate. The Pareto optimal ones are printed as JSON lines and the most
+balanced one is saved as a parameter file for respeaker_node.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+
+import numpy as np
+
+from respeaker_ros2 import replay
+
+
+# values searched when no --param is given
+DEFAULT_SPACE = {
+    'speech_prefetch': [0.2, 0.35, 0.5],
+    'speech_continuation': [0.2, 0.35, 0.5, 0.8],
+    'speech_min_duration': [0.1, 0.3, 0.5],
+    'speech_max_duration': [7.0],
+    'vad_threshold': [6.0, 10.0, 14.0],
+}
+
+OBJECTIVES = ['boundary_error', 'truncation_rate', 'false_segment_rate']
+
+# per-file features shared by the configurations evaluated in a worker process
+_features = None
+_vad_cache = {}
+
+
+def read_labels(path):
+    labels = []
+    with open(path) as f:
+        for line in f:
+            cols = line.strip().split('\t')
+            if len(cols) >= 2:
+                labels.append((float(cols[0]), float(cols[1])))
+    return np.array(sorted(labels)).reshape(-1, 2)
+
+
+def load_features(path, config, cache_dir=None):
+    """Per-file data which does not depend on the searched parameters."""
+    cache_path = None
+    if cache_dir is not None:
+        stat = os.stat(path)
+        key = hashlib.sha1(('%s:%d:%d:%s:%s' % (
+            os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+            config['update_rate'], config['main_channel'])).encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, key + '.npz')
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        num_frames, rate, energy = int(cached['num_frames']), int(cached['rate']), cached['energy']
+    else:
+        num_frames, rate, energy, _ = replay.scan_wav(
+            path, config['main_channel'], config['update_rate'])
+        if cache_path is not None:
+            np.savez(cache_path, num_frames=num_frames, rate=rate, energy=energy)
+
+    vad = None
+    if os.path.exists(replay.trace_path(path)):
+        ticks = replay.tick_times(num_frames, rate, config['update_rate'])
+        vad = replay.load_trace_vad(replay.trace_path(path), ticks)
+    return {
+        'path': path,
+        'num_frames': num_frames,
+        'rate': rate,
+        'energy': energy,
+        'vad': vad,
+        'labels': read_labels(os.path.splitext(path)[0] + '.txt'),
+    }
+
+
+def init_worker(features):
+    global _features
+    _features = features
+
+
+def get_vad(index, threshold):
+    features = _features[index]
+    if features['vad'] is not None:
+        return features['vad']
+    key = (index, threshold)
+    if key not in _vad_cache:
+        _vad_cache[key] = replay.energy_vad(features['energy'], threshold)
+    return _vad_cache[key]
+
+
+def score(segments, labels, tolerance=0.05):
+    """Return (boundary error sum, matched labels, truncated labels, false segments)."""
+    # chunks of a long utterance are scored as one segment
+    utterances = {}
+    for s in segments:
+        if s.accepted:
+            start, end = utterances.get(s.utterance, (s.start, s.end))
+            utterances[s.utterance] = (min(start, s.start), max(end, s.end))
+    segments = np.array(sorted(utterances.values())).reshape(-1, 2)
+    if len(labels) and len(segments):
+        overlap = (np.minimum(labels[:, None, 1], segments[None, :, 1]) -
+                   np.maximum(labels[:, None, 0], segments[None, :, 0]))
+    else:
+        overlap = np.zeros((len(labels), len(segments)))
+    error, matched, truncated = 0.0, 0, 0
+    for i, (start, end) in enumerate(labels):
+        if len(segments) == 0 or overlap[i].max() <= 0:
+            truncated += 1
+            continue
+        seg_start, seg_end = segments[overlap[i].argmax()]
+        error += abs(seg_start - start) + abs(seg_end - end)
+        matched += 1
+        if seg_start > start + tolerance or seg_end < end - tolerance:
+            truncated += 1
+    false_segments = int((overlap <= 0).all(axis=0).sum()) if len(labels) else len(segments)
+    return error, matched, truncated, false_segments, len(segments)
+
+
+def evaluate(config):
+    error, matched, truncated, false_segments, num_segments, num_labels = 0.0, 0, 0, 0, 0, 0
+    for index, features in enumerate(_features):
+        vad = get_vad(index, config['vad_threshold'])
+        segments = replay.segment(features['num_frames'], features['rate'], vad, config)
+        e, m, t, f, n = score(segments, features['labels'])
+        error += e
+        matched += m
+        truncated += t
+        false_segments += f
+        num_segments += n
+        num_labels += len(features['labels'])
+    return dict(config,
+                boundary_error=error / max(matched, 1),
+                truncation_rate=truncated / float(max(num_labels, 1)),
+                false_segment_rate=false_segments / float(max(num_segments, 1)))
+
+
+def pareto_front(results):
+    values = np.array([[r[o] for o in OBJECTIVES] for r in results])
+    front = []
+    for i, v in enumerate(values):
+        dominated = ((values <= v).all(axis=1) & (values < v).any(axis=1)).any()
+        if not dominated:
+            front.append(results[i])
+    return front
+
+
+def balanced(front):
+    """The configuration closest to the ideal point after normalizing objectives."""
+    values = np.array([[r[o] for o in OBJECTIVES] for r in front])
+    low, high = values.min(axis=0), values.max(axis=0)
+    normalized = (values - low) / np.where(high > low, high - low, 1.0)
+    return front[int(np.linalg.norm(normalized, axis=1).argmin())]
+
+
+def write_params(path, config, result):
+    with open(path, 'w') as f:
+        f.write('# Generated by respeaker_sweep\n')
+        for o in OBJECTIVES:
+            f.write('# %s: %f\n' % (o, result[o]))
+        if 'vad_threshold' in result:
+            f.write('# energy VAD threshold used offline: %s dB (not a device parameter)\n' %
+                    result['vad_threshold'])
+        f.write('/**:\n')
+        f.write('  ros__parameters:\n')
+        for name in sorted(replay.DEFAULT_CONFIG):
+            if name in ('vad_threshold', 'frames_per_buffer'):
+                continue
+            f.write('    %s: %r\n' % (name, result.get(name, config[name])))
+
+
+def parse_space(params):
+    space = {}
+    for param in params:
+        name, values = param.split('=', 1)
+        if name not in replay.DEFAULT_CONFIG:
+            raise ValueError('Unknown parameter %s' % name)
+        if ':' in values:
+            low, high = values.split(':')
+            space[name] = (float(low), float(high))
+        else:
+            space[name] = [type(replay.DEFAULT_CONFIG[name])(v) for v in values.split(',')]
+    return space
+
+
+def configurations(base, space, samples=None, seed=0):
+    names = sorted(space)
+    if samples is None:
+        for name in names:
+            if isinstance(space[name], tuple):
+                raise ValueError('Ranges (%s) need --samples for random search' % name)
+        for values in itertools.product(*[space[n] for n in names]):
+            yield dict(base, **dict(zip(names, values)))
+        return
+    rng = random.Random(seed)
+    for _ in range(samples):
+        config = dict(base)
+        for name in names:
+            if isinstance(space[name], tuple):
+                config[name] = rng.uniform(*space[name])
+            else:
+                config[name] = rng.choice(space[name])
+        yield config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+', help='labeled multichannel 16 bit WAV files')
+    parser.add_argument('-p', '--param', action='append', default=[],
+                        help='NAME=v1,v2,... (values) or '
+                             'NAME=low:high (range, random search only)')
+    parser.add_argument('-n', '--samples', type=int,
+                        help='random search with this number of samples instead of grid search')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--cache-dir', help='cache per-file features here between runs')
+    parser.add_argument('-o', '--output', default='respeaker_params.yaml',
+                        help='parameter file of the most balanced Pareto optimal configuration')
+    parser.add_argument('--update-rate', type=float, default=replay.DEFAULT_CONFIG['update_rate'])
+    parser.add_argument('--main-channel', type=int, default=replay.DEFAULT_CONFIG['main_channel'])
+    args = parser.parse_args(argv)
+
+    base = dict(replay.DEFAULT_CONFIG,
+                update_rate=args.update_rate, main_channel=args.main_channel)
+    space = parse_space(args.param) if args.param else dict(DEFAULT_SPACE)
+    if args.cache_dir is not None and not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        features = list(pool.map(load_features, args.files, itertools.repeat(base),
+                                 itertools.repeat(args.cache_dir)))
+    if all(f['vad'] is not None for f in features):
+        # recorded VAD does not depend on the energy threshold
+        space.pop('vad_threshold', None)
+
+    configs = list(configurations(base, space, args.samples, args.seed))
+    sys.stderr.write('Evaluating %d configurations on %d files\n' % (len(configs), len(features)))
+    chunksize = max(1, len(configs) // (4 * (args.jobs or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                             initargs=(features,)) as pool:
+        results = list(pool.map(evaluate, configs, chunksize=chunksize))
+
+    front = pareto_front(results)
+    for result in sorted(front, key=lambda r: [r[o] for o in OBJECTIVES]):
+        print(json.dumps({k: result[k] for k in sorted(space) + OBJECTIVES}))
+    best = balanced(front)
+    if 'vad_threshold' not in space:
+        best = {k: v for k, v in best.items() if k != 'vad_threshold'}
+    write_params(args.output, base, best)
+    sys.stderr.write('%d Pareto optimal configurations. Saved %s\n' % (len(front), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,8 @@ setup(
         'console_scripts': [
             'respeaker_node = respeaker_ros2.respeaker_node:main',
             'speech_to_text = respeaker_ros2.speech_to_text:main',
+            'respeaker_replay = respeaker_ros2.replay:main',
+            'respeaker_sweep = respeaker_ros2.sweep:main',
         ],
     },
 )
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+
+from respeaker_ros2.audio_clock import AudioClock
+
+
+RATE = 16000
+CHUNK = 1024
+# the device clock runs slow by 50 ppm
+PERIOD = (1.0 + 50e-6) / RATE
+
+
+def run(clock, chunks, begin=0, rng=None, lost=(), overflow=False, delays=None):
+    """Feed chunks captured with up to 3 ms of delay. Return (true capture time, stamp) pairs.
+
+    Chunks whose index is in lost are dropped before reaching the clock.
+    """
+    rng = rng or random.Random(0)
+    delays = delays or {}
+    results = []
+    flag = False
+    for i in range(begin, begin + chunks):
+        if i in lost:
+            flag = overflow
+            continue
+        true = 100.0 + i * CHUNK * PERIOD
+        measured = true + delays.get(i, rng.uniform(0.0, 0.003))
+        _, stamp = clock.add(CHUNK, measured, overflow=flag)
+        flag = False
+        results.append((true, stamp))
+    return results
+
+
+def max_error(results):
+    return max(abs(stamp - true) for true, stamp in results)
+
+
+def test_drift_compensated():
+    clock = AudioClock(RATE)
+    rng = random.Random(0)
+    run(clock, 500, rng=rng)
+    results = run(clock, 2000, begin=500, rng=rng)
+    assert max_error(results) < 0.001
+    assert abs(clock.skew - 50e-6) < 5e-6
+    assert clock.lost_frames == 0
+
+
+def test_flagged_gap():
+    clock = AudioClock(RATE)
+    rng = random.Random(0)
+    run(clock, 500, rng=rng)
+    results = run(clock, 2000, begin=500, rng=rng, lost=range(1000, 1010), overflow=True)
+    # lost frames are known up to the delay of a chunk until the next window
+    assert max_error(results[500:520]) < 0.004
+    assert max_error(results[:500] + results[520:]) < 0.001
+    assert abs(clock.lost_frames - 10 * CHUNK) <= 16
+
+
+def test_unflagged_gap():
+    clock = AudioClock(RATE)
+    rng = random.Random(0)
+    run(clock, 500, rng=rng)
+    results = run(clock, 2000, begin=500, rng=rng, lost=range(1000, 1010))
+    # the first chunk after the gap is stamped before the gap is confirmed
+    assert max_error(results[501:521]) < 0.004
+    assert max_error(results[:500] + results[521:]) < 0.001
+    assert abs(clock.lost_frames - 10 * CHUNK) <= 16
+    assert abs(clock.skew - 50e-6) < 5e-6
+
+
+def test_delayed_callbacks_not_lost():
+    clock = AudioClock(RATE)
+    rng = random.Random(0)
+    run(clock, 500, rng=rng)
+    # callbacks stalled for 3 chunks and catching up
+    delays = {1000: 3 * CHUNK / float(RATE), 1001: 2 * CHUNK / float(RATE),
+              1002: CHUNK / float(RATE)}
+    results = run(clock, 2000, begin=500, rng=rng, delays=delays)
+    assert clock.lost_frames == 0
+    assert max_error(results) < 0.001
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+
+import pytest
+
+from respeaker_ros2.segmenter import SpeechSegmenter
+
+
+RATE = 1000
+
+
+def samples(begin, end):
+    """Audio whose samples hold their frame number, to check which frames a segment holds."""
+    return array.array('H', range(begin, end)).tobytes()
+
+
+def frames(segment):
+    return array.array('H', segment.data)
+
+
+def feed(segmenter, begin, end, chunk=100):
+    chunks = []
+    for i in range(begin, end, chunk):
+        chunks += segmenter.add_audio(samples(i, min(i + chunk, end)))
+    return chunks
+
+
+def speak(segmenter, begin, end, stop):
+    """Feed silence until begin, speech until end and silence until stop (in frames).
+
+    VAD is updated at the end of each period of 100 frames. Return all segments.
+    """
+    segments = []
+    for i in range(0, stop, 100):
+        segments += feed(segmenter, i, i + 100)
+        seg = segmenter.update((i + 100) / float(RATE), begin <= i < end)
+        if seg is not None:
+            segments.append(seg)
+    return segments
+
+
+def make(**kwargs):
+    config = dict(rate=RATE, sample_width=2, prefetch=0.3, continuation=0.2,
+                  min_duration=0.3, max_duration=7.0, chunk_overlap=0.5)
+    config.update(kwargs)
+    return SpeechSegmenter(**config)
+
+
+def test_prefetch_included():
+    segments = speak(make(), 1000, 2000, 3000)
+    assert len(segments) == 1
+    seg = segments[0]
+    # speech is detected at 1.1 s, audio is kept from 0.3 s before the VAD update preceding it
+    assert seg.start == pytest.approx(0.8)
+    assert seg.accepted and seg.final
+    data = frames(seg)
+    assert data[0] == 800
+    assert list(data) == list(range(800, 800 + len(data)))
+    assert seg.duration == pytest.approx(len(data) / float(RATE))
+
+
+def test_prefetch_at_beginning():
+    segments = speak(make(), 0, 1000, 2000)
+    assert len(segments) == 1
+    assert segments[0].start == 0.0
+    assert frames(segments[0])[0] == 0
+
+
+def test_min_duration():
+    short, = speak(make(min_duration=0.7), 1000, 1100, 3000)
+    assert short.duration < 0.7
+    assert not short.accepted
+    long_, = speak(make(min_duration=0.7), 1000, 1500, 3000)
+    assert long_.duration >= 0.7
+    assert long_.accepted
+
+
+def test_utterances_counted():
+    segmenter = make()
+    first = speak(segmenter, 1000, 1500, 3000)
+    second = speak(segmenter, 1000, 1500, 3000)
+    assert [s.utterance for s in first + second] == [0, 1]
+
+
+@pytest.mark.parametrize('max_duration', [7.0, 1.0])
+def test_keep_audio_same_boundaries(max_duration):
+    def boundaries(keep_audio):
+        segmenter = make(max_duration=max_duration, keep_audio=keep_audio)
+        segments = speak(segmenter, 1000, 4000, 6000) + speak(segmenter, 500, 700, 2000)
+        return [(s.start, s.end, s.accepted, s.utterance, s.index, s.final) for s in segments]
+    assert boundaries(True) == boundaries(False)
+
+
+def check_chunks(segments, max_frames, overlap_frames):
+    for seg in segments:
+        assert len(seg.data) <= 2 * max_frames
+        assert seg.duration == pytest.approx(len(seg.data) / 2.0 / RATE)
+    for prev, seg in zip(segments, segments[1:]):
+        assert seg.utterance == prev.utterance
+        assert seg.index == prev.index + 1
+        assert not prev.final
+        assert len(prev.data) == 2 * max_frames
+        # the next chunk starts with the end of the previous one
+        assert list(frames(seg)[:overlap_frames]) == list(frames(prev)[-overlap_frames:])
+        assert seg.start == pytest.approx(prev.end - overlap_frames / float(RATE))
+    assert segments[-1].final
+
+
+def test_long_speech_chunked():
+    segments = speak(make(max_duration=1.0, chunk_overlap=0.2), 1000, 4000, 5000)
+    assert len(segments) == 4
+    assert all(s.accepted for s in segments)
+    check_chunks(segments, 1000, 200)
+    # all audio from the prefetch to the end of speech is passed on
+    assert frames(segments[0])[0] == 800
+    assert frames(segments[-1])[-1] == 4199
+
+
+def test_long_chunk_accepted():
+    # the first chunk is accepted even though its duration reaches max_duration
+    segments = speak(make(max_duration=1.0, min_duration=0.5), 1000, 2000, 3000)
+    assert [s.index for s in segments] == [0, 1]
+    assert segments[0].accepted and segments[1].accepted
+
+
+
+def test_speech_filling_one_chunk_accepted():
+    # prefetch and speech fill the buffer to exactly max_duration without cutting a chunk
+    seg, = speak(make(max_duration=1.0, chunk_overlap=0.2), 1000, 1401, 3000)
+    assert seg.duration == pytest.approx(1.0)
+    assert seg.final and seg.accepted
+
+
+def test_prefetch_longer_than_chunk():
+    segmenter = make(prefetch=2.0, max_duration=1.0, chunk_overlap=0.2)
+    segments = speak(segmenter, 3000, 5000, 6000)
+    check_chunks(segments, 1000, 200)
+    # the prefetch is shortened to leave room for new audio in the first chunk
+    assert frames(segments[0])[0] == 3100 - 800
+    assert frames(segments[-1])[-1] == 5199
+
+
+def test_stamp_of_first_frame():
+    segmenter = make()
+    segments = []
+    for i in range(0, 3000, 100):
+        # the capture clock runs slightly slow
+        stamp = 100.0 + i * 1.001 / RATE
+        segments += segmenter.add_audio(samples(i, i + 100), stamp)
+        seg = segmenter.update((i + 100) / float(RATE), 1000 <= i < 2000)
+        if seg is not None:
+            segments.append(seg)
+    seg, = segments
+    assert frames(seg)[0] == 800
+    assert seg.stamp == pytest.approx(100.0 + 800 * 1.001 / RATE)
+
+
+def test_stamp_without_stamps():
+    seg, = speak(make(), 1000, 1500, 3000)
+    assert seg.stamp is None
+
+
+def test_gap_filled():
+    segmenter = make()
+    segments = []
+    for i in range(0, 3000, 100):
+        if i in (1500, 1600):
+            # chunks lost before dispatch
+            continue
+        segments += segmenter.add_audio(samples(i, i + 100), 100.0 + i / float(RATE))
+        seg = segmenter.update((i + 100) / float(RATE), 1000 <= i < 2000)
+        if seg is not None:
+            segments.append(seg)
+    seg, = segments
+    data = frames(seg)
+    assert seg.stamp == pytest.approx(100.8)
+    # the lost audio is replaced by silence of the same length
+    assert data[700:900] == array.array('H', bytes(400))
+    assert data[900] == 1700
+    assert seg.duration == pytest.approx(len(data) / float(RATE))
+    assert seg.stamp + seg.duration == pytest.approx(100.0 + (data[-1] + 1) / float(RATE))